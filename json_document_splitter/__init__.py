@@ -1,8 +1,10 @@
 from .split import split as split
+from .split import split_many as split_many
 from .graph import Graph as Graph
 from .graph import create_graph as create_graph
 from .cluster import Cluster as Cluster
 from .cluster import ClusterCandidate as ClusterCandidate
+from .cluster import ClusterCache as ClusterCache
 from .cluster import sample_clusters as sample_clusters
 from .cluster import create_clusters as create_clusters
 from .visualize import visualize as visualize
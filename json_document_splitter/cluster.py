@@ -1,9 +1,10 @@
 import math
+import heapq
 from time import time
 from random import Random
-from typing import List, Set, cast, Dict, Callable, Any, Union, Optional
-from dataclasses import dataclass
-from .graph import Graph, NodeId
+from typing import List, Set, cast, Dict, Callable, Any, Union, Optional, Tuple
+from dataclasses import dataclass, field
+from .graph import Graph, NodeId, create_node_id
 from .types import NodeId
 
 
@@ -21,6 +22,23 @@ class Cluster():
   weight: int
   child_keys: Optional[Set[Union[str, int]]] = None
 
+@dataclass
+class ClusterCache():
+  """ Weights and reconstructed candidates that can be shared between runs on the same graph and weight functions """
+  weights: Dict[str, int] = field(default_factory=dict)
+  candidates: Dict[str, ClusterCandidate] = field(default_factory=dict)
+  exact_weight_total: int = 0
+  estimate_total: int = 0
+  calibration_count: int = 0
+
+@dataclass
+class MergeInput():
+  """ A cluster as it was before being merged, kept to undo merges accepted on an estimated weight """
+  cluster_id: int
+  cluster: Cluster
+  node_ids: List[NodeId]
+  inputs: Optional[List['MergeInput']] = None # if the cluster's weight is estimated
+
 
 def sample_clusters(
   graph: Graph,
@@ -29,8 +47,17 @@ def sample_clusters(
   max_iterations: int = 1,
   timeout: Optional[int] = None,
   seed: Optional[int] = None,
+  estimate_weight: Optional[Callable[[ClusterCandidate], int]] = None,
+  estimate_margin: float = 0.2,
+  estimate_sample_size: int = 10,
+  prefer_lightest: bool = False,
+  cache: Optional[ClusterCache] = None,
+  initial_clusters: Optional[List[Cluster]] = None,
 ) -> List[Cluster]:
   rand = Random(seed)
+  cache = cache or ClusterCache()
+  if prefer_lightest:
+    max_iterations = 1
 
   attempts: List[List[Cluster]] = []
   for iteration in range(max_iterations):
@@ -40,6 +67,12 @@ def sample_clusters(
       rand=rand if iteration > 0 else None,
       calculate_weight=calculate_weight,
       timeout=timeout / max_iterations if timeout else None,
+      estimate_weight=estimate_weight,
+      estimate_margin=estimate_margin,
+      estimate_sample_size=estimate_sample_size,
+      prefer_lightest=prefer_lightest,
+      cache=cache,
+      initial_clusters=initial_clusters,
     )
     attempts.append(attempt)
   
@@ -59,7 +92,30 @@ def create_clusters(
   calculate_weight: Callable[[ClusterCandidate], int],
   rand: Optional[Random] = None,
   timeout: Optional[int] = None,
+  estimate_weight: Optional[Callable[[ClusterCandidate], int]] = None,
+  estimate_margin: float = 0.2,
+  estimate_sample_size: int = 10,
+  prefer_lightest: bool = False,
+  cache: Optional[ClusterCache] = None,
+  initial_clusters: Optional[List[Cluster]] = None,
 ) -> List[Cluster]:
+  """
+  estimate_weight is a cheap proxy for calculate_weight, scaled by a ratio
+  calibrated against the exact weights seen so far, starting with a sample of
+  estimate_sample_size leaves. Only candidates estimated within estimate_margin
+  of max_weight are weighed exactly. Clusters accepted on an estimate are
+  weighed exactly at the end. A merge that turns out to be over max_weight is
+  undone, and the restored clusters are merged again using exact weights.
+
+  With prefer_lightest, siblings are packed in order (and for objects also
+  heaviest first) under a range of limits down to the lowest that keeps the
+  cluster count, and the packing with the fewest and most even clusters is
+  merged. This gives balanced clusters without random restarts, so
+  sample_clusters runs a single iteration.
+
+  initial_clusters (e.g. the result for a smaller max_weight) are used as the
+  starting clusters instead of one cluster per leaf node.
+  """
   start_at = time()
   
   node_ids = list(graph.nodes.keys())
@@ -70,8 +126,9 @@ def create_clusters(
   cluster_by_node: Dict[NodeId, int] = {}
   clusters: Dict[int, Cluster] = {}
 
-  calculcate_weight_cache: Dict[str, int] = {}
-  reconstruct_cache: Dict[str, ClusterCandidate] = {}
+  cache = cache or ClusterCache()
+  calculcate_weight_cache = cache.weights
+  reconstruct_cache = cache.candidates
   
   def calculate_weight_cached(candidate: ClusterCandidate) -> int:
     cache_key = f'{candidate.path} {candidate.child_keys}'
@@ -79,8 +136,41 @@ def create_clusters(
       return calculcate_weight_cache[cache_key]
     weight = calculate_weight(candidate)
     calculcate_weight_cache[cache_key] = weight
+    calibrate(candidate, weight)
     return weight
 
+  use_estimates = True
+  # Inputs of each cluster whose weight is estimated, to undo its merge if needed
+  merge_inputs: Dict[int, List[MergeInput]] = {}
+
+  def calibrate(candidate: ClusterCandidate, weight: int):
+    if estimate_weight:
+      cache.exact_weight_total += weight
+      cache.estimate_total += estimate_weight(candidate)
+      cache.calibration_count += 1
+
+  def estimate(candidate: ClusterCandidate) -> Optional[float]:
+    """ Returns the calibrated estimate, or None if the exact weight should be used """
+    if not estimate_weight or not use_estimates:
+      return None
+    if cache.calibration_count < estimate_sample_size or cache.estimate_total <= 0:
+      return None
+    if f'{candidate.path} {candidate.child_keys}' in calculcate_weight_cache:
+      return None
+    return estimate_weight(candidate) * cache.exact_weight_total / cache.estimate_total
+
+  def weigh(candidate: ClusterCandidate, limit: int = max_weight) -> Tuple[Optional[int], bool]:
+    """ Returns (weight or None if over limit, whether weight is exact) """
+    estimated = estimate(candidate)
+    if estimated is not None:
+      if estimated > limit * (1 + estimate_margin):
+        return None, False
+      if estimated < limit * (1 - estimate_margin):
+        return math.ceil(estimated), False
+
+    weight = calculate_weight_cached(candidate)
+    return (weight if weight <= limit else None), True
+
   def reconstruct_cached(node_ids: List[NodeId]) -> ClusterCandidate:
     cache_key = str(sorted(node_ids))
     if cache_key in reconstruct_cache:
@@ -89,101 +179,336 @@ def create_clusters(
     reconstruct_cache[cache_key] = reconstructed
     return reconstructed
 
-  # 1. Create initial cluster for each leaf node
+  parent_by_node: Dict[NodeId, NodeId] = {}
+  for (source, target) in graph.edges:
+    parent_by_node[target] = source
+  children_by_node: Dict[NodeId, List[NodeId]] = {node_id: [] for node_id in node_ids}
   for node_id in node_ids:
-    has_children = any([source == node_id for (source, target) in graph.edges])
-    if has_children:
-      continue
+    if node_id in parent_by_node:
+      children_by_node[parent_by_node[node_id]].append(node_id)
+
+  nodes_by_cluster: Dict[int, List[NodeId]] = {}
+
+  def descendants(node_id: NodeId) -> List[NodeId]:
+    return [node_id] + [id for child_id in children_by_node[node_id] for id in descendants(child_id)]
+
+  # 1. Create initial clusters from initial_clusters and for each remaining leaf node
+  for initial_cluster in initial_clusters or []:
+    cluster_node_id = create_node_id(initial_cluster.path)
+    if initial_cluster.child_keys is None:
+      cluster_node_ids = descendants(cluster_node_id)
+    else:
+      cluster_node_ids = [
+        id
+        for child_id in children_by_node[cluster_node_id]
+        if graph.nodes[child_id].path[-1] in initial_cluster.child_keys
+        for id in descendants(child_id)
+      ]
+
+    cluster_id = len(clusters) + 1
+    for id in cluster_node_ids:
+      cluster_by_node[id] = cluster_id
+    nodes_by_cluster[cluster_id] = cluster_node_ids
+    clusters[cluster_id] = Cluster(
+      path=initial_cluster.path,
+      value=initial_cluster.value,
+      child_keys=initial_cluster.child_keys,
+      weight=initial_cluster.weight,
+    )
 
+  leaf_ids = [
+    node_id
+    for node_id in node_ids
+    if not children_by_node[node_id] and not node_id in cluster_by_node
+  ]
+  if estimate_weight:
+    # Calibrate the estimate on a sample spread over the leaves
+    for node_id in leaf_ids[::max(1, len(leaf_ids) // max(1, estimate_sample_size))]:
+      node = graph.nodes[node_id]
+      calculate_weight_cached(ClusterCandidate(path=node.path, value=node.value))
+
+  for node_id in leaf_ids:
     node = graph.nodes[node_id]
     cluster_id = len(clusters) + 1
     cluster_by_node[node_id] = cluster_id
+    nodes_by_cluster[cluster_id] = [node_id]
+    candidate = ClusterCandidate(path=node.path, value=node.value)
+    estimated = estimate(candidate)
+    if estimated is not None and estimated < max_weight * (1 - estimate_margin):
+      weight = math.ceil(estimated)
+      merge_inputs[cluster_id] = []
+    else:
+      weight = calculate_weight_cached(candidate)
     clusters[cluster_id] = Cluster(
       path=node.path,
       value=node.value,
-      weight=calculate_weight(ClusterCandidate(path=node.path, value=node.value)),
+      weight=weight,
     )
-  
-  changed = True
-  while changed:
-    if timeout and time() - start_at > timeout:
-      raise TimeoutError('Timeout exceeded')
 
-    changed = False
+  def snapshot(cluster_id: int) -> MergeInput:
+    return MergeInput(
+      cluster_id=cluster_id,
+      cluster=clusters[cluster_id],
+      node_ids=nodes_by_cluster[cluster_id],
+      inputs=merge_inputs.get(cluster_id),
+    )
 
-    for node_id in node_ids:
-      if not node_id in cluster_by_node:
-        continue
+  def set_cluster(
+    cluster_id: int,
+    candidate: ClusterCandidate,
+    weight: int,
+    inputs: Optional[List[MergeInput]],
+  ):
+    clusters[cluster_id] = Cluster(
+      path=candidate.path,
+      value=candidate.value,
+      child_keys=candidate.child_keys,
+      weight=weight,
+    )
+    if inputs is None:
+      merge_inputs.pop(cluster_id, None)
+    else:
+      merge_inputs[cluster_id] = inputs
 
-      # Get each node's parent and siblings (merging candidates)
-      parent_id = next(iter(graph.predecessors(node_id)), None)
-      if not parent_id or parent_id in cluster_by_node:
-        continue
-      parent = graph.nodes[parent_id]
-      siblings = [n for n in graph.successors(parent_id) if n != node_id]
+  # Clusters only grow while merging, so a cluster id and size identify its nodes
+  failed_merges: Set[Tuple[int, int, int, int]] = set()
 
+  def try_merge(cluster_id: int, other_cluster_id: int) -> bool:
+    merge_key = (
+      cluster_id,
+      len(nodes_by_cluster[cluster_id]),
+      other_cluster_id,
+      len(nodes_by_cluster[other_cluster_id]),
+    )
+    if merge_key in failed_merges:
+      return False
+
+    combined_node_ids = nodes_by_cluster[cluster_id] + nodes_by_cluster[other_cluster_id]
+    combined_candidate = reconstruct_cached(combined_node_ids)
+    combined_weight, is_exact = weigh(combined_candidate)
+    if combined_weight is None:
+      failed_merges.add(merge_key)
+      return False
+
+    inputs = None if is_exact else [snapshot(cluster_id), snapshot(other_cluster_id)]
+    set_cluster(cluster_id, combined_candidate, combined_weight, inputs)
+    del clusters[other_cluster_id]
+    merge_inputs.pop(other_cluster_id, None)
+    for id in nodes_by_cluster.pop(other_cluster_id):
+      cluster_by_node[id] = cluster_id
+    nodes_by_cluster[cluster_id] = combined_node_ids
+    return True
+
+  def is_adjacent(node_id: NodeId, sibling_id: NodeId) -> bool:
+    node_array_idx = cast(int, graph.nodes[node_id].path[-1])
+    sibling_array_idx = cast(int, graph.nodes[sibling_id].path[-1])
+    return node_array_idx == sibling_array_idx - 1
+
+  def merge_children_in_order(parent_id: NodeId) -> bool:
+    changed = False
+    parent = graph.nodes[parent_id]
+    for node_id in children_by_node[parent_id]:
+      if not node_id in cluster_by_node:
+        continue
+      siblings = [n for n in children_by_node[parent_id] if n != node_id]
       if rand and not parent.type == 'array':
         rand.shuffle(siblings)
-      
-      node_cluster_id = cluster_by_node[node_id]
 
+      node_cluster_id = cluster_by_node[node_id]
       for sibling_id in siblings:
         if not sibling_id in cluster_by_node:
           continue
-        sibling_cluster_id = cluster_by_node[sibling_id]
-
-        if node_cluster_id == sibling_cluster_id:
+        if cluster_by_node[sibling_id] == node_cluster_id:
           continue
-        
-        if parent.type == 'array':
-          node_array_idx = cast(int, graph.nodes[node_id].path[-1])
-          sibling_array_idx = cast(int, graph.nodes[sibling_id].path[-1])
-          if node_array_idx != sibling_array_idx - 1:
-            continue
-
-        combined_node_ids = [
-          id
-          for id, cluster_id in cluster_by_node.items()
-          if cluster_id in [node_cluster_id, sibling_cluster_id]
-        ]
-        combined_candidate = reconstruct_cached(combined_node_ids)
-
-        combined_weight = calculate_weight_cached(combined_candidate)
-        if combined_weight > max_weight:
+        if parent.type == 'array' and not is_adjacent(node_id, sibling_id):
           continue
+        if try_merge(node_cluster_id, cluster_by_node[sibling_id]):
+          changed = True
+    return changed
 
-        clusters[node_cluster_id] = Cluster(
-          path=combined_candidate.path,
-          value=combined_candidate.value,
-          child_keys=combined_candidate.child_keys,
-          weight=combined_weight,
-        )
-
-        if sibling_cluster_id:
-          del clusters[sibling_cluster_id]
-          for id, cluster_id in cluster_by_node.items():
-            if cluster_id == sibling_cluster_id:
-              cluster_by_node[id] = node_cluster_id
-        
-        changed = True
-      
-      is_all_siblings_in_same_cluster = all([
-        cluster_by_node.get(sibling_id) == node_cluster_id
-        for sibling_id in siblings
-      ])
-      if is_all_siblings_in_same_cluster:
-        combined_node_ids = [node_id, parent_id] + siblings
-        combined_candidate = reconstruct_cached(combined_node_ids)
-        combined_weight = calculate_weight_cached(combined_candidate)
-        if combined_weight <= max_weight:
-          clusters[node_cluster_id] = Cluster(
-            path=combined_candidate.path,
-            value=combined_candidate.value,
-            child_keys=combined_candidate.child_keys,
-            weight=combined_weight,
+  def merge_children_balanced(parent_id: NodeId) -> bool:
+    parent = graph.nodes[parent_id]
+    children = [n for n in children_by_node[parent_id] if n in cluster_by_node]
+    if parent.type == 'array':
+      children.sort(key=lambda id: cast(int, graph.nodes[id].path[-1]))
+
+    cluster_ids: List[int] = []
+    for node_id in children:
+      if not cluster_by_node[node_id] in cluster_ids:
+        cluster_ids.append(cluster_by_node[node_id])
+    if len(cluster_ids) < 2:
+      return False
+
+    # Array clusters can only be extended by the next adjacent cluster
+    first_child_by_cluster: Dict[int, NodeId] = {}
+    last_child_by_cluster: Dict[int, NodeId] = {}
+    for node_id in children:
+      first_child_by_cluster.setdefault(cluster_by_node[node_id], node_id)
+      last_child_by_cluster[cluster_by_node[node_id]] = node_id
+
+    def weigh_bin(bin: List[int], limit: int) -> Optional[int]:
+      node_ids = [id for cluster_id in bin for id in nodes_by_cluster[cluster_id]]
+      weight, _ = weigh(reconstruct_cached(node_ids), limit)
+      return weight
+
+    def pack(order: List[int], limit: int) -> Tuple[List[List[int]], List[int]]:
+      """ Groups array clusters in order, and object clusters into the first group they fit """
+      bins: List[List[int]] = []
+      weights: List[int] = []
+      for cluster_id in order:
+        if parent.type == 'array':
+          can_extend = bool(bins) and is_adjacent(
+            last_child_by_cluster[bins[-1][-1]],
+            first_child_by_cluster[cluster_id],
           )
-          cluster_by_node[parent_id] = node_cluster_id
+          bin_indices = [len(bins) - 1] if can_extend else []
+        else:
+          bin_indices = list(range(len(bins)))
+
+        for i in bin_indices:
+          weight = weigh_bin(bins[i] + [cluster_id], limit)
+          if weight is not None:
+            bins[i].append(cluster_id)
+            weights[i] = weight
+            break
+        else:
+          bins.append([cluster_id])
+          weights.append(clusters[cluster_id].weight)
+      return bins, weights
+
+    # Pack in node order (like merging in order) and, for objects, heaviest
+    # first. Then lower the limit as far as the cluster count allows, and keep
+    # the packing with the fewest and most even clusters.
+    orders = [cluster_ids]
+    if parent.type == 'object':
+      orders.append(sorted(cluster_ids, key=lambda id: -clusters[id].weight))
+
+    packings: List[Tuple[List[List[int]], List[int]]] = []
+    for order in orders:
+      count = len(pack(order, max_weight)[0])
+      # No cluster can be lighter than the heaviest child cluster, or than an
+      # even share of all of them (for weights that add up when merging)
+      low = max(
+        max(clusters[cluster_id].weight for cluster_id in cluster_ids),
+        sum(clusters[cluster_id].weight for cluster_id in cluster_ids) // count,
+      )
+      high = max_weight
+      packings.append(pack(order, high))
+      while low < high:
+        limit = (low + high) // 2
+        packing = pack(order, limit)
+        if len(packing[0]) <= count:
+          packings.append(packing)
+          high = limit
+        else:
+          low = limit + 1
+
+    bins, _ = min(packings, key=lambda packing: (len(packing[0]), std(packing[1])))
+    changed = False
+    for bin in bins:
+      for cluster_id in bin[1:]:
+        if try_merge(bin[0], cluster_id):
           changed = True
+    return changed
+
+  def merge_with_parent(parent_id: NodeId) -> bool:
+    children = children_by_node[parent_id]
+    cluster_ids = set([cluster_by_node.get(child_id) for child_id in children])
+    if len(cluster_ids) != 1 or None in cluster_ids:
+      return False
+
+    cluster_id = cast(int, next(iter(cluster_ids)))
+    combined_node_ids = nodes_by_cluster[cluster_id] + [parent_id]
+    combined_candidate = reconstruct_cached(combined_node_ids)
+    combined_weight, is_exact = weigh(combined_candidate)
+    if combined_weight is None:
+      return False
+
+    inputs = None if is_exact else [snapshot(cluster_id)]
+    set_cluster(cluster_id, combined_candidate, combined_weight, inputs)
+    cluster_by_node[parent_id] = cluster_id
+    nodes_by_cluster[cluster_id] = combined_node_ids
+    return True
+
+  # 2. Merge children of parents on the worklist, deepest parents first so
+  # that a parent's children have settled by the time it is visited. A parent
+  # is revisited only if something changed among its children, and its own
+  # parent is queued once it has been merged into its children's cluster.
+  worklist: List[Tuple[int, int, NodeId]] = [] # (-depth, enqueue order, parent id)
+  queued: Set[NodeId] = set()
+  enqueued_count = [0]
+
+  def enqueue(parent_id: NodeId):
+    if parent_id not in queued:
+      queued.add(parent_id)
+      enqueued_count[0] += 1
+      heapq.heappush(worklist, (-len(graph.nodes[parent_id].path), enqueued_count[0], parent_id))
+
+  for node_id in node_ids:
+    if node_id in cluster_by_node and node_id in parent_by_node:
+      enqueue(parent_by_node[node_id])
+
+  def merge_worklist():
+    while worklist:
+      if timeout and time() - start_at > timeout:
+        raise TimeoutError('Timeout exceeded')
+
+      _, _, parent_id = heapq.heappop(worklist)
+      queued.discard(parent_id)
+      if parent_id in cluster_by_node:
+        continue
+
+      if prefer_lightest:
+        changed = merge_children_balanced(parent_id)
+      else:
+        changed = merge_children_in_order(parent_id)
+
+      # Balanced merging packs all children at once, while merging in order
+      # may have missed merges made possible later in the pass
+      if merge_with_parent(parent_id):
+        if parent_id in parent_by_node:
+          enqueue(parent_by_node[parent_id])
+      elif changed and not prefer_lightest:
+        enqueue(parent_id)
+
+  # 3. Weigh clusters accepted on an estimate exactly, and undo merges that
+  # turn out to be over max_weight. Parents of undone merges are queued again.
+  def verify_estimated_clusters():
+    unverified_cluster_ids = list(merge_inputs.keys())
+    while unverified_cluster_ids:
+      cluster_id = unverified_cluster_ids.pop()
+      inputs = merge_inputs.pop(cluster_id)
+      cluster = clusters[cluster_id]
+      cluster.weight = calculate_weight_cached(ClusterCandidate(
+        path=cluster.path,
+        value=cluster.value,
+        child_keys=cluster.child_keys,
+      ))
+      if cluster.weight <= max_weight or not inputs:
+        continue
+
+      del clusters[cluster_id]
+      for id in nodes_by_cluster.pop(cluster_id):
+        del cluster_by_node[id]
+      for merge_input in inputs:
+        clusters[merge_input.cluster_id] = merge_input.cluster
+        nodes_by_cluster[merge_input.cluster_id] = merge_input.node_ids
+        for id in merge_input.node_ids:
+          cluster_by_node[id] = merge_input.cluster_id
+        if merge_input.inputs is not None:
+          merge_inputs[merge_input.cluster_id] = merge_input.inputs
+          unverified_cluster_ids.append(merge_input.cluster_id)
+      for id in nodes_by_cluster[inputs[0].cluster_id]:
+        if id in parent_by_node and parent_by_node[id] not in cluster_by_node:
+          enqueue(parent_by_node[id])
+
+  merge_worklist()
+  verify_estimated_clusters()
+  if worklist:
+    # Offer clusters restored by undone merges to be merged again, with exact weights
+    use_estimates = False
+    failed_merges.clear()
+    merge_worklist()
 
   return list(clusters.values())
 
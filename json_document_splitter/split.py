@@ -1,7 +1,7 @@
 import json
 from typing import Callable, Dict, List, Optional, Union
 from .graph import create_graph
-from .cluster import sample_clusters, ClusterCandidate, Cluster
+from .cluster import sample_clusters, ClusterCandidate, Cluster, ClusterCache
 
 
 def split(
@@ -11,6 +11,9 @@ def split(
   timeout: Optional[int] = None,
   seed: int = 42,
   dumps: Callable[[ClusterCandidate], int] = lambda candidate: len(json.dumps(candidate.value)),
+  estimate: Optional[Callable[[ClusterCandidate], int]] = None,
+  estimate_margin: float = 0.2,
+  prefer_lightest: bool = False,
 ) -> List[Cluster]:
   graph = create_graph(document)
   clusters = sample_clusters(
@@ -20,5 +23,52 @@ def split(
     timeout=timeout,
     calculate_weight=dumps,
     seed=seed,
+    estimate_weight=estimate,
+    estimate_margin=estimate_margin,
+    prefer_lightest=prefer_lightest,
   )
   return clusters
+
+
+def split_many(
+  document: Union[Dict, List[Dict]],
+  max_lengths: List[int],
+  max_iterations: int = 10,
+  timeout: Optional[int] = None,
+  seed: int = 42,
+  dumps: Callable[[ClusterCandidate], int] = lambda candidate: len(json.dumps(candidate.value)),
+  estimate: Optional[Callable[[ClusterCandidate], int]] = None,
+  estimate_margin: float = 0.2,
+  prefer_lightest: bool = False,
+) -> List[List[Cluster]]:
+  """
+  Splits the document once per max_length, returned in the same order. The
+  graph and weights are shared, and the clusters for each max_length are
+  used as the starting clusters for the next larger one, which then needs a
+  single iteration instead of max_iterations.
+
+  Starting from the smaller clusters keeps their boundaries, so the larger
+  max_lengths can get somewhat more chunks than calling split for each.
+  """
+  graph = create_graph(document)
+  cache = ClusterCache()
+  unique_max_lengths = sorted(set(max_lengths))
+
+  clusters_by_max_length: Dict[int, List[Cluster]] = {}
+  initial_clusters: Optional[List[Cluster]] = None
+  for max_length in unique_max_lengths:
+    initial_clusters = sample_clusters(
+      graph,
+      max_weight=max_length,
+      max_iterations=max_iterations if initial_clusters is None else 1,
+      timeout=timeout / len(unique_max_lengths) if timeout else None,
+      calculate_weight=dumps,
+      seed=seed,
+      estimate_weight=estimate,
+      estimate_margin=estimate_margin,
+      prefer_lightest=prefer_lightest,
+      cache=cache,
+      initial_clusters=initial_clusters,
+    )
+    clusters_by_max_length[max_length] = initial_clusters
+  return [clusters_by_max_length[max_length] for max_length in max_lengths]
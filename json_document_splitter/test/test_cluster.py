@@ -1,7 +1,9 @@
+import json
 import unittest
+from random import Random
 from typing import Any, Dict, List, Union
 from ..graph import create_graph
-from ..cluster import sample_clusters, Cluster
+from ..cluster import sample_clusters, create_clusters, std, Cluster, ClusterCandidate, ClusterCache
 
 class TestClusterGraph(unittest.TestCase):
 
@@ -10,6 +12,7 @@ class TestClusterGraph(unittest.TestCase):
     document: Union[Dict, List],
     max_weight: int,
     max_iterations: int = 1,
+    prefer_lightest: bool = False,
   ):
     def sum_of_leaf_values(value: Any):
       if isinstance(value, list):
@@ -24,6 +27,7 @@ class TestClusterGraph(unittest.TestCase):
       max_weight=max_weight,
       max_iterations=max_iterations,
       calculate_weight=lambda candidate: sum_of_leaf_values(candidate.value),
+      prefer_lightest=prefer_lightest,
     )
 
 
@@ -55,6 +59,58 @@ class TestClusterGraph(unittest.TestCase):
       self.assertIn(expected, clusters)
 
 
+  def test_returns_balanced_clusters_when_preferring_lightest(self):
+    value = { 'a': 3, 'b': 1, 'c': 1, 'd': 2 }
+    in_order = self.cluster(value, max_weight=5)
+    clusters = self.cluster(value, max_weight=5, prefer_lightest=True)
+
+    self.assertEqual(sorted(c.weight for c in in_order), [2, 5])
+    expected_clusters = [
+      Cluster(path=[], child_keys={'a', 'b'}, weight=4, value={ 'a': 3, 'b': 1 }),
+      Cluster(path=[], child_keys={'c', 'd'}, weight=3, value={ 'c': 1, 'd': 2 }),
+    ]
+    self.assertEqual(len(clusters), len(expected_clusters))
+    for expected in expected_clusters:
+      self.assertIn(expected, clusters)
+
+
+  def test_balances_adjacent_array_items_when_preferring_lightest(self):
+    in_order = self.cluster([3, 1, 1, 2], max_weight=5)
+    clusters = self.cluster([3, 1, 1, 2], max_weight=5, prefer_lightest=True)
+
+    self.assertEqual(sorted(c.weight for c in in_order), [2, 5])
+    expected_clusters = [
+      Cluster(path=[], child_keys={0, 1}, weight=4, value=[3, 1]),
+      Cluster(path=[], child_keys={2, 3}, weight=3, value=[1, 2]),
+    ]
+    self.assertEqual(len(clusters), len(expected_clusters))
+    for expected in expected_clusters:
+      self.assertIn(expected, clusters)
+
+
+  def test_preferring_lightest_is_no_worse_than_in_order_on_records(self):
+    rand = Random(1)
+    data = [
+      {
+        'id': i,
+        'name': f'user{i}',
+        'bio': 'x' * rand.randint(0, 80),
+        'tags': [f'tag{j}' for j in range(rand.randint(0, 5))],
+      }
+      for i in range(100)
+    ]
+    graph = create_graph(data)
+    calculate_weight = lambda candidate: len(json.dumps(candidate.value))
+
+    for max_weight in [100, 300, 1000, 2000]:
+      in_order = sample_clusters(graph, max_weight, calculate_weight)
+      clusters = sample_clusters(graph, max_weight, calculate_weight, prefer_lightest=True)
+      self.assertLessEqual(len(clusters), len(in_order))
+      self.assertLessEqual(std([c.weight for c in clusters]), std([c.weight for c in in_order]))
+      if max_weight == 2000:
+        self.assertLess(std([c.weight for c in clusters]), std([c.weight for c in in_order]) / 2)
+
+
   def test_clusters_with_parent_if_all_children_are_clustered(self):
     value = {
       'a': 1,
@@ -125,5 +181,121 @@ class TestClusterGraph(unittest.TestCase):
       self.assertIn(expected, clusters)
 
 
+  def test_skips_merges_that_already_failed(self):
+    data = [{ 'a': 1, 'b': 2, 'c': { 'd': 3, 'e': [4, 5] } } for i in range(50)]
+    graph = create_graph(data)
+
+    weight_lookups = [0]
+    class CountingDict(dict):
+      def __contains__(self, key):
+        weight_lookups[0] += 1
+        return super().__contains__(key)
+
+    create_clusters(
+      graph,
+      max_weight=40,
+      calculate_weight=lambda candidate: len(json.dumps(candidate.value)),
+      cache=ClusterCache(weights=CountingDict()),
+    )
+
+    # The full sweeps this replaced looked up 450 merge weights, as they
+    # retried every failed merge on each sweep. Leaves are looked up once each.
+    leaf_count = 50 * 5
+    self.assertEqual(weight_lookups[0] - leaf_count, 350)
+
+
+  def test_estimated_weights_are_exact_and_within_budget(self):
+    data = [{ 'id': i, 'name': 'x' * (i % 7), 'tags': ['a', 'b'] * (i % 3) } for i in range(200)]
+    graph = create_graph(data)
+
+    exact_calls = [0]
+    def calculate_weight(candidate: ClusterCandidate) -> int:
+      exact_calls[0] += 1
+      return len(json.dumps(candidate.value))
+
+    create_clusters(graph, max_weight=200, calculate_weight=calculate_weight)
+    calls_without_estimate = exact_calls[0]
+
+    exact_calls[0] = 0
+    clusters = create_clusters(
+      graph,
+      max_weight=200,
+      calculate_weight=calculate_weight,
+      estimate_weight=lambda candidate: len(str(candidate.value)),
+    )
+    self.assertLess(exact_calls[0] * 10, calls_without_estimate)
+    for cluster in clusters:
+      self.assertEqual(cluster.weight, len(json.dumps(cluster.value)))
+      self.assertLessEqual(cluster.weight, 200)
+
+
+  def test_undoes_merges_over_budget_if_estimate_is_wrong(self):
+    value = { 'a': 1, 'b': 2, 'c': 3, 'd': 15 }
+    graph = create_graph(value)
+    exact_calls = [0]
+    def calculate_weight(candidate: ClusterCandidate) -> int:
+      exact_calls[0] += 1
+      return sum(candidate.value.values()) if isinstance(candidate.value, dict) else candidate.value
+
+    clusters = create_clusters(
+      graph,
+      max_weight=20,
+      calculate_weight=calculate_weight,
+      estimate_weight=lambda candidate: 1,
+      estimate_sample_size=4,
+    )
+
+    expected_clusters = [
+      Cluster(path=[], child_keys={'a', 'b', 'c'}, weight=6, value={ 'a': 1, 'b': 2, 'c': 3 }),
+      Cluster(path=['d'], weight=15, value=15),
+    ]
+    self.assertEqual(len(clusters), len(expected_clusters))
+    for expected in expected_clusters:
+      self.assertIn(expected, clusters)
+    # 4 sampled leaves, then the root, all its children and a, b, c when undoing merges
+    self.assertEqual(exact_calls[0], 7)
+
+
+  def test_merges_clusters_again_after_undoing_merges(self):
+    value = { 'a': 5, 'b': 5, 'c': 5, 'd': 5 }
+    graph = create_graph(value)
+    clusters = create_clusters(
+      graph,
+      max_weight=12,
+      calculate_weight=lambda candidate: sum(candidate.value.values()) if isinstance(candidate.value, dict) else candidate.value,
+      estimate_weight=lambda candidate: 1,
+      estimate_sample_size=4,
+    )
+
+    # Undoing a+b+c+d leaves a+b, c and d, after which c and d can still merge
+    expected_clusters = [
+      Cluster(path=[], child_keys={'a', 'b'}, weight=10, value={ 'a': 5, 'b': 5 }),
+      Cluster(path=[], child_keys={'c', 'd'}, weight=10, value={ 'c': 5, 'd': 5 }),
+    ]
+    self.assertEqual(len(clusters), len(expected_clusters))
+    for expected in expected_clusters:
+      self.assertIn(expected, clusters)
+
+
+  def test_continues_from_initial_clusters(self):
+    value = { 'a': 1, 'nested': { 'b': 2, 'c': 3 } }
+    graph = create_graph(value)
+    calculate_weight = lambda candidate: len(json.dumps(candidate.value))
+    cache = ClusterCache()
+
+    small = create_clusters(graph, max_weight=10, calculate_weight=calculate_weight, cache=cache)
+    cached_weights = len(cache.weights)
+    large = create_clusters(
+      graph,
+      max_weight=100,
+      calculate_weight=calculate_weight,
+      cache=cache,
+      initial_clusters=small,
+    )
+    self.assertGreater(len(small), 1)
+    self.assertEqual(large, [Cluster(path=[], weight=len(json.dumps(value)), value=value)])
+    self.assertGreater(len(cache.weights), cached_weights)
+
+
 if __name__ == '__main__':
   unittest.main()
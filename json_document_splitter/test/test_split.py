@@ -0,0 +1,45 @@
+import json
+import unittest
+from ..split import split, split_many
+
+class TestSplit(unittest.TestCase):
+
+  def test_split_many_returns_one_split_per_max_length(self):
+    document = [{ 'id': i, 'name': 'x' * (i % 7), 'tags': ['a', 'b'] * (i % 3) } for i in range(20)]
+    max_lengths = [400, 100, 200]
+
+    splits = split_many(document, max_lengths, max_iterations=1)
+    self.assertEqual(len(splits), len(max_lengths))
+    for max_length, clusters in zip(max_lengths, splits):
+      for cluster in clusters:
+        self.assertLessEqual(cluster.weight, max_length)
+        self.assertEqual(cluster.weight, len(json.dumps(cluster.value)))
+    self.assertLess(len(splits[0]), len(splits[2]))
+    self.assertLess(len(splits[2]), len(splits[1]))
+
+
+  def test_split_many_chunk_counts_are_close_to_split(self):
+    document = [{ 'id': i, 'name': 'x' * (i % 7), 'tags': ['a', 'b'] * (i % 3) } for i in range(100)]
+    max_lengths = [100, 200, 400]
+
+    splits = split_many(document, max_lengths)
+    independent = [split(document, max_length) for max_length in max_lengths]
+
+    # The smallest max_length is not seeded, so it matches split exactly
+    self.assertEqual(splits[0], independent[0])
+    # Larger ones keep the smaller chunks' boundaries, which can cost a few more chunks
+    for clusters, independent_clusters in zip(splits[1:], independent[1:]):
+      self.assertLessEqual(len(clusters), len(independent_clusters) * 1.1)
+
+
+  def test_split_many_with_duplicate_max_lengths(self):
+    document = { 'a': 'x' * 50, 'b': 'y' * 50 }
+    splits = split_many(document, [60, 200, 60], timeout=10)
+    self.assertEqual(len(splits), 3)
+    self.assertEqual(splits[0], splits[2])
+    self.assertEqual(len(splits[0]), 2)
+    self.assertEqual(len(splits[1]), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()